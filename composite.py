@@ -4,6 +4,8 @@
 # Install required packages (numpy and opencv) with pip:
 #     pip3 install opencv-python
 #     pip3 install numpy
+# Optionally install numba to speed up composites with fractional widths:
+#     pip3 install numba
 # Usage: python3 composite.py [options] <input_file>
 # Options:
 #     -h                Print this message, then exit
@@ -18,10 +20,53 @@
 #     Q                 Print current width and step size
 #     Enter             Export composite to output file (set by -o)
 
+import os
 import sys
 import math
+import atexit
+import queue
+import tempfile
+import collections
+import threading
 import numpy as np
 import cv2
+try:
+  from numba import njit, prange
+except ImportError:
+  njit = None
+
+# Decode up to end frames from a video stream on a background thread, so that
+# decoding the next frames overlaps with processing the current one
+def read_frames(capture, end, queue_size=32):
+  frame_queue = queue.Queue(maxsize=queue_size)
+  def decode():
+    try:
+      count = 0
+      while count < end:
+        success, image = capture.read()
+        if not success:
+          break
+        frame_queue.put(image)
+        count += 1
+    finally:
+      frame_queue.put(None)   # Signal end of stream, even if decoding failed
+  thread = threading.Thread(target=decode, daemon=True)
+  thread.start()
+  image = frame_queue.get()
+  while image is not None:
+    yield image
+    image = frame_queue.get()
+  thread.join()
+
+# Remove a full-scale aggregate's backing file at exit
+def remove_agg_file(agg_file):
+  # Drop cached composites (which keep the aggregate alive) so its mapping is
+  # released, otherwise Windows refuses to delete the file
+  composite_cache.clear()
+  try:
+    os.remove(agg_file)
+  except OSError:
+    print('WARNING: Couldn\'t remove temporary file:', agg_file)
 
 # Convert a video stream to an aggregate image (composite with height=1)
 def read_agg_image(capture, full_scale=False, end=None):
@@ -31,19 +76,27 @@ def read_agg_image(capture, full_scale=False, end=None):
   if full_scale:
     frame_width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
     frame_height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    agg_image = np.zeros(dtype=np.uint8, shape=(frame_height, frame_width*end, 3))
+    # Full-scale aggregates can be far larger than memory, so back them with a
+    # temporary file and let the OS page them in and out as needed. The file
+    # goes in the working directory, since the default temp directory is often
+    # a RAM-backed tmpfs.
+    fd, agg_file = tempfile.mkstemp(suffix='.agg', dir='.')
+    os.close(fd)
+    atexit.register(remove_agg_file, agg_file)
+    agg_image = np.memmap(agg_file, dtype=np.uint8, mode='w+',
+        shape=(frame_height, frame_width*max(1, end), 3))
   else:
     agg_image = np.zeros(dtype=np.uint8, shape=(1, end, 3))
-  success, image = capture.read()
   count = 0
-  while success and count < end:
-    if full_scale:
+  if full_scale:
+    # Whole frames are large, so keep fewer of them queued
+    for image in read_frames(capture, end, queue_size=8):
       agg_image[0:frame_height, frame_width*count:frame_width*(count+1)] = image
-    else:
-      mean_color = image.mean(axis=0).mean(axis=0)
-      agg_image[0, count] = mean_color
-    success, image = capture.read()
-    count += 1
+      count += 1
+  else:
+    for image in read_frames(capture, end):
+      agg_image[0, count] = cv2.mean(image)[0:3]
+      count += 1
   if full_scale:
     return agg_image[:, 0:frame_width*count, :]
   else:
@@ -52,50 +105,139 @@ def read_agg_image(capture, full_scale=False, end=None):
 # Resize an image to given width, using compositing rules
 def pad_resize(image, mega_width, frame_width=1, frame_height=1):
   frame_count = image.shape[1] // frame_width
-  height = math.ceil(frame_count / (mega_width / 1000.0))
-  if frame_width == 1 and frame_height == 1 and mega_width % 1000 == 0:
-    pad_image = np.zeros(dtype=np.uint8, shape=(1, height * math.ceil(mega_width / 1000.0), 3))
-    pad_image[0:1, 0:frame_count, 0:3] = image[0:1, 0:frame_count, 0:3]
-    ret_image = pad_image.reshape(height, math.ceil(mega_width / 1000.0), 3)
+  height = (frame_count * 1000 + mega_width - 1) // mega_width
+  cols = (mega_width + 999) // 1000
+  ret_image = np.zeros(dtype=np.uint8, shape=(height * frame_height, cols * frame_width, 3))
+  if mega_width % 1000 == 0:
+    # Every row holds the same number of frames, so full rows are just the
+    # aggregate's frames reordered into a grid, followed by one partial row
+    frames = get_frame_view(image, frame_count, frame_width, frame_height)
+    grid = ret_image.reshape(height, frame_height, cols, frame_width, 3)
+    full_rows = frame_count // cols
+    grid[0:full_rows] = frames[:, 0:full_rows*cols] \
+        .reshape(frame_height, full_rows, cols, frame_width, 3).transpose(1, 0, 2, 3, 4)
+    if full_rows < height:
+      grid[full_rows, :, 0:frame_count - full_rows*cols] = frames[:, full_rows*cols:]
   else:
-    ret_image = np.zeros(dtype=np.uint8, shape=(height * frame_height, math.ceil(mega_width / 1000.0) * frame_width, 3))
-    x = 0
-    y = 0
-    accumulator = 0
-    for i in range(frame_count):
-      y_offset = y*frame_height
-      x_offset = x*frame_width
-      ret_image[y*frame_height:(y+1)*frame_height, x*frame_width:(x+1)*frame_width] = \
-          image[0:frame_height, i*frame_width:(i+1)*frame_width]
-      accumulator += 1000
-      x += 1
-      if accumulator >= mega_width:
-        accumulator -= mega_width
-        x = 0
-        y += 1
+    if frame_width == 1 and frame_height == 1:
+      if njit is not None:
+        place_pixels(image, ret_image, frame_count, mega_width)
+      else:
+        y_idx, x_idx = get_frame_offsets(frame_count, mega_width)
+        ret_image[y_idx, x_idx] = image[0, 0:frame_count]
+    elif njit is not None:
+      place_tiles(image, ret_image, frame_count, frame_width, frame_height, mega_width)
+    else:
+      # Scatter all frames into the grid at once
+      frames = get_frame_view(image, frame_count, frame_width, frame_height)
+      y_idx, x_idx = get_frame_offsets(frame_count, mega_width)
+      grid = ret_image.reshape(height, frame_height, cols, frame_width, 3)
+      grid[y_idx, :, x_idx] = frames.transpose(1, 0, 2, 3)
   return ret_image
 
+# View an aggregate image as a stack of frames with shape (frame_height,
+# frame_count, frame_width, 3). This never copies, even when the aggregate is
+# a cropped slice (which reshape would have to copy).
+def get_frame_view(image, frame_count, frame_width, frame_height):
+  return np.lib.stride_tricks.as_strided(image,
+      shape=(frame_height, frame_count, frame_width, 3),
+      strides=(image.strides[0], frame_width*image.strides[1], image.strides[1], image.strides[2]))
+
+# Recently generated composites, so the gui can redraw widths it has already
+# shown. Bounded by total size, since full-scale composites can be huge.
+composite_cache = collections.OrderedDict()
+COMPOSITE_CACHE_BYTES = 256 * 1024 * 1024
+
+# Same as pad_resize, but reuse the result if this composite was made recently.
+# Returned images are shared with the cache, so they are marked read-only.
+def cached_pad_resize(image, mega_width, frame_width=1, frame_height=1):
+  key = (id(image), mega_width, frame_width, frame_height)
+  if key in composite_cache:
+    composite_cache.move_to_end(key)
+    return composite_cache[key][1]
+  ret_image = pad_resize(image, mega_width, frame_width, frame_height)
+  ret_image.flags.writeable = False
+  # Keep a reference to image so that its id can't be reused while cached
+  composite_cache[key] = (image, ret_image)
+  # Evict the least recently used composites, but always keep the newest one
+  # (it is on screen anyway)
+  cache_bytes = sum(entry[1].nbytes for entry in composite_cache.values())
+  while cache_bytes > COMPOSITE_CACHE_BYTES and len(composite_cache) > 1:
+    cache_bytes -= composite_cache.popitem(last=False)[1][1].nbytes
+  return ret_image
+
+# Compute the grid position (row, column) of every frame in a composite of
+# given mega-width. A new row is started whenever the frames placed so far
+# reach the width, so rows alternate between floor(width) and ceil(width) frames.
+def get_frame_offsets(frame_count, mega_width):
+  row_width = max(mega_width, 1000)   # Narrower composites still hold one frame per row
+  i = np.arange(frame_count, dtype=np.int64)
+  y_idx = i * 1000 // row_width
+  x_idx = i - (y_idx * row_width + 999) // 1000
+  return y_idx, x_idx
+
+# Copy every frame of an aggregate image into its tile of a composite, using
+# the same layout as get_frame_offsets. Tiles never overlap, so frames are
+# copied in parallel when compiled with numba.
+def place_tiles(image, ret_image, frame_count, frame_width, frame_height, mega_width):
+  row_width = max(mega_width, 1000)
+  for i in prange(frame_count):
+    y = i * 1000 // row_width
+    x = i - (y * row_width + 999) // 1000
+    for r in range(frame_height):
+      for c in range(frame_width):
+        for k in range(3):
+          ret_image[y*frame_height + r, x*frame_width + c, k] = image[r, i*frame_width + c, k]
+
+# Copy every pixel of a single-pixel aggregate into a composite, starting a new
+# row whenever the accumulated width reaches mega_width. This is sequential but
+# needs no offset arrays, so it is the fastest layout once compiled with numba.
+def place_pixels(image, ret_image, frame_count, mega_width):
+  x = 0
+  y = 0
+  accumulator = 0
+  for i in range(frame_count):
+    for k in range(3):
+      ret_image[y, x, k] = image[0, i, k]
+    accumulator += 1000
+    x += 1
+    if accumulator >= mega_width:
+      accumulator -= mega_width
+      x = 0
+      y += 1
+
+if njit is not None:
+  place_tiles = njit(parallel=True, cache=True)(place_tiles)
+  place_pixels = njit(cache=True)(place_pixels)
+
+# Write an image to disk, using fast encoder settings for its format
+def write_image(out_file, image):
+  if out_file.lower().endswith('.jpg') or out_file.lower().endswith('.jpeg'):
+    params = [cv2.IMWRITE_JPEG_QUALITY, 90, cv2.IMWRITE_JPEG_OPTIMIZE, 0]
+  else:
+    # Composites are mostly smooth gradients, so the fastest zlib level costs little in size
+    params = [cv2.IMWRITE_PNG_COMPRESSION, 1, cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_DEFAULT]
+  if cv2.imwrite(out_file, image, params):
+    print('Image saved to', out_file)
+  else:
+    print('ERROR: Couldn\'t write image:', out_file)
+
+# Same as write_image, but on a background thread so that the caller isn't
+# blocked while the image is compressed. Returns the (already started) thread.
+def write_image_async(out_file, image):
+  thread = threading.Thread(target=write_image, args=(out_file, image))
+  thread.start()
+  return thread
+
 # Generate a unique output file name, using "out.png" as template
 def get_unique_out_file():
-  out_file = ''
+  out_file = 'out.png'
   n = 0
-  exists = True
-  while exists:
-    out_file = 'out%d.png' % n if n > 0 else 'out.png'
-    try:
-      open(out_file)
-      n += 1
-    except FileNotFoundError:
-      exists = False
+  while os.path.exists(out_file):
+    n += 1
+    out_file = 'out%d.png' % n
   return out_file
 
-  # Check if input file exists
-  try:
-    open(in_file)
-  except FileNotFoundError:
-    print('ERROR: Input file not found:', in_file)
-    return    # Exit prematurely
-
 def main():
   # Initialize arguments to be parsed from command line
   in_file = None
@@ -197,9 +339,7 @@ def main():
     print('WARNING: Auto mode enabled with no specified width (square will be used)')
 
   # Check if input file exists
-  try:
-    open(in_file)
-  except FileNotFoundError:
+  if not os.path.isfile(in_file):
     print('ERROR: Input file not found:', in_file)
     return    # Exit prematurely
 
@@ -250,23 +390,23 @@ def main():
   # Calculate a good starting width (if not already specified by user)
   if final_width <= 0:
     final_width = int(math.ceil(math.sqrt(agg_image.shape[1] / agg_image.shape[0])))
-  final_width = int(1000 * final_width)   # Convert to mega-width
+  final_width = int(round(1000 * final_width))   # Convert to mega-width (an int from here on)
 
   # If auto mode is enabled, make one composite and exit
   if no_gui:
     final_image = pad_resize(agg_image, final_width, frame_width, frame_height)
     final_out_file = get_unique_out_file() if out_file == '' else out_file
-    cv2.imwrite(final_out_file, final_image)
-    print('Image saved to', final_out_file)
+    write_image(final_out_file, final_image)
     return
 
   # Enter gui mode
   cv2.namedWindow('Composite Image', cv2.WINDOW_NORMAL)
   redraw = True
   step_size = 1000
+  write_thread = None
   while True:
     if redraw:
-      final_image = pad_resize(agg_image, final_width, frame_width, frame_height)
+      final_image = cached_pad_resize(agg_image, final_width, frame_width, frame_height)
       cv2.imshow('Composite Image', final_image)
       redraw = False
     key = cv2.waitKey(0)
@@ -289,9 +429,11 @@ def main():
       print_step_size = step_size // 1000 if step_size >= 1000 else step_size / 1000
       print('width=%r, step_size=%r' % (print_width, print_step_size))
     elif key == 13:
+      # Finish any previous export first, so get_unique_out_file can see it
+      if write_thread is not None:
+        write_thread.join()
       final_out_file = get_unique_out_file() if out_file == '' else out_file
-      cv2.imwrite(final_out_file, final_image)
-      print('Image saved to', final_out_file)
+      write_thread = write_image_async(final_out_file, final_image)
     elif key == 27:
       cv2.destroyAllWindows()
       return